@@ -1,18 +1,53 @@
 #!/usr/bin/env python3
-import os, json, subprocess, tempfile, glob, html, sys
+import os, subprocess, tempfile, html, sys
+import orjson
+import gzip, hashlib, re, functools, fnmatch, time
 from datetime import datetime
 import shutil
-from collections import defaultdict
+from collections import defaultdict, Counter
 import webbrowser
 from flask import Flask, send_from_directory, render_template_string
 import threading
 import argparse
+import urllib.request
+
+STAGES = ("before", "fixed", "fine_tuned")  # validate.json keys, also used as run labels
+SEMGREP_TIMEOUT = 60  # seconds, per snippet
+SEMGREP_MAX_RUN_TIMEOUT = 30 * 60  # seconds, cap for a single semgrep run however many snippets it has
+DEFAULT_SEMGREP_CONFIGS = ["p/security-audit", "p/csharp"]
+SEMGREP_REGISTRY_URL = "https://semgrep.dev/c/"
+RESULT_CACHE_DIR = os.path.expanduser("~/.cache/sgbatch")
+REGISTRY_RULES_DIR = os.path.join(RESULT_CACHE_DIR, "registry")  # shared by every scan
+REGISTRY_RULES_MAX_AGE = 24 * 3600  # seconds before a registry snapshot is refreshed
+REGISTRY_RETRY_AFTER = 3600  # seconds to wait after a failed prefetch before hitting the network again
+# Opening fence line, body, and an optional closing fence on its own line
+FENCE_RE = re.compile(r"\A```[^\n]*\n?(?P<body>.*?)(?:\n?^[ \t]*```)?\Z", re.DOTALL | re.MULTILINE)
+# Comments and using directives - a snippet with nothing else has nothing for semgrep to match
+TRIVIAL_CODE_RE = re.compile(r"//[^\n]*|/\*.*?\*/|^[ \t]*using\s+[\w.=\s]+;", re.DOTALL | re.MULTILINE)
+# Skip telemetry, update checks and .gitignore traversal - all pure per-run latency for us
+SEMGREP_FAST_FLAGS = ["--metrics=off", "--disable-version-check", "--no-git-ignore", "--no-rewrite-rule-ids"]
+
+# Rule IDs and severities repeat across hundreds of rows, so memoise their escaping
+_esc_cached = functools.lru_cache(maxsize=4096)(html.escape)
+
+# Report templates for the detailed findings tables
+SEV_COLORS = {"ERROR": "#d32f2f", "WARNING": "#f57c00", "INFO": "#1976d2"}
+SNIPPET_LINK_TMPL = '<a href="#" onclick="showSnippet(\'{stage_id}\', {snippet_idx}); return false;" style="color:#2196F3;text-decoration:underline;font-weight:bold">#{snippet_idx}</a>'
+SNIPPET_CELL_TMPL = '<td rowspan="{rowspan}">{link}</td>'
+PROMPT_CELL_TMPL = '<td rowspan="{rowspan}" style="font-size:12px">{prompt}</td>'
+DETAIL_ROW_TMPL = """<tr>
+                  {snippet_cell}
+                  {prompt_cell}
+                  <td><span style="background:{sev_color};color:white;padding:2px 8px;border-radius:3px;font-size:11px">{severity}</span></td>
+                  <td style="font-size:12px">{rule}</td>
+                  <td>{line}</td>
+                  <td style="font-size:12px">{message}</td>
+                </tr>"""
 
-CUSTOM_CONFIG_PATH = "config/semgrep_custom_config.json"
 
 def load_vuln_config(config_path="validate.json"):
-    with open(config_path, "r") as f:
-        return json.load(f)
+    with open(config_path, "rb") as f:
+        return orjson.loads(f.read())
 
 
 def load_custom_semgrep_config(config_path="semgrep_custom_config.json"):
@@ -21,20 +56,60 @@ def load_custom_semgrep_config(config_path="semgrep_custom_config.json"):
         print(f"⚠ Custom config not found: {config_path}, using default rules only")
         return {}
     
-    with open(config_path, "r") as f:
-        custom_config = json.load(f)
+    with open(config_path, "rb") as f:
+        custom_config = orjson.loads(f.read())
     
     print(f"✓ Loaded custom semgrep config: {len(custom_config.get('--config', []))} custom rules")
     return custom_config
 
 
-def build_semgrep_command(tmp_path, custom_config=None):
-    """Build semgrep command with default and custom configs"""
-    cmd = ["semgrep", "scan"]
+def cached_rules_path(config, cache_dir):
+    return os.path.join(cache_dir, config.replace("/", "_") + ".yaml")
+
+
+def prefetch_registry_rules(cache_dir=REGISTRY_RULES_DIR):
+    """Download the default registry rulesets (at most once per REGISTRY_RULES_MAX_AGE) so
+    semgrep loads them from disk instead of the network; after a failed download the
+    next attempt waits REGISTRY_RETRY_AFTER, so offline runs don't stall on timeouts"""
+    os.makedirs(cache_dir, exist_ok=True)
+    for config in DEFAULT_SEMGREP_CONFIGS:
+        rules_path = cached_rules_path(config, cache_dir)
+        failed_marker = rules_path + ".failed"
+        if os.path.exists(rules_path) and time.time() - os.path.getmtime(rules_path) < REGISTRY_RULES_MAX_AGE:
+            continue
+        if os.path.exists(failed_marker) and time.time() - os.path.getmtime(failed_marker) < REGISTRY_RETRY_AFTER:
+            continue
+        # A stale snapshot still beats the network if the refresh fails
+        fallback = "the previous snapshot is kept" if os.path.exists(rules_path) else "semgrep will fetch it itself"
+        try:
+            with urllib.request.urlopen(SEMGREP_REGISTRY_URL + config, timeout=30) as resp:
+                rules = resp.read()
+        except OSError as e:
+            rules, problem = None, f"Could not prefetch {config} ({e})"
+        else:
+            problem = None if b"rules:" in rules[:4096] else f"Unexpected registry response for {config}"
+        if problem:
+            print(f"⚠ {problem}, {fallback}; not retrying for {REGISTRY_RETRY_AFTER // 60} min")
+            with open(failed_marker, "w"):
+                pass
+            continue
+        with open(rules_path + ".tmp", "wb") as f:
+            f.write(rules)
+        os.replace(rules_path + ".tmp", rules_path)
+        if os.path.exists(failed_marker):
+            os.remove(failed_marker)
+        print(f"✓ Cached registry rules: {config} -> {rules_path}")
+
+
+def build_semgrep_command(target_path, custom_config=None, output_path=None, rules_cache_dir=None):
+    """Build semgrep command with default and custom configs (target may be a file or directory)"""
+    cmd = ["semgrep", "scan", *SEMGREP_FAST_FLAGS]
     
-    # Add default configs
-    cmd.extend(["--config", "p/security-audit"])
-    cmd.extend(["--config", "p/csharp"])
+    # Add default configs, preferring the local snapshot from prefetch_registry_rules()
+    for config in DEFAULT_SEMGREP_CONFIGS:
+        if rules_cache_dir and os.path.exists(cached_rules_path(config, rules_cache_dir)):
+            config = cached_rules_path(config, rules_cache_dir)
+        cmd.extend(["--config", config])
     
     # Add custom configs if provided
     if custom_config and "--config" in custom_config:
@@ -51,37 +126,239 @@ def build_semgrep_command(tmp_path, custom_config=None):
             else:
                 print(f"    ⚠ Custom rule not found: {config_path}")
     
-    cmd.extend(["--json", tmp_path])
+    if output_path:
+        cmd.extend(["--output", output_path])
+    cmd.extend(["--json", target_path])
     return cmd
 
 
-def scan_jsonl_file(jsonl_path, output_dir, run_label, vuln_type, custom_config=None, max_snippets=None):
-    """Scan a JSONL file with semgrep and return results"""
+def semgrep_output_path(target_path):
+    """Where semgrep writes its JSON for target_path: next to it, never inside a scanned directory"""
+    return f"{target_path.rstrip(os.sep)}.semgrep.json"
+
+
+def parse_semgrep_output(returncode, output_path, stderr):
+    """Turn a finished semgrep process into (parsed, error message)"""
+    if returncode not in [0, 1]:
+        message = f"semgrep error (code {returncode})"
+        if stderr:
+            message += f"\n    stderr: {stderr[:300].decode(errors='replace')}"
+        return None, message
+
+    # Read the output file in one large buffered read; orjson parses the bytes directly
+    try:
+        with open(output_path, "rb", buffering=1 << 20) as f:
+            output = f.read()
+    except FileNotFoundError:
+        output = b""
+    if not output.strip():
+        return None, "empty output"
+
+    return orjson.loads(output), None
+
+
+# semgrep-core has no long-lived request/response mode to stream snippets into,
+# so a single batched invocation is how rule parsing gets amortised
+def run_semgrep(target_path, custom_config=None, timeout=SEMGREP_TIMEOUT, rules_cache_dir=None):
+    """Run semgrep once over a file or directory; returns (parsed, error message)"""
+    # Findings go to a file rather than through the stdout pipe, so they are read in one
+    # buffered pass instead of being reassembled from 64 KiB pipe chunks
+    output_path = semgrep_output_path(target_path)
+    cmd = build_semgrep_command(target_path, custom_config, output_path, rules_cache_dir)
+    
+    try:
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout
+        )
+        return parse_semgrep_output(result.returncode, output_path, result.stderr)
+    except subprocess.TimeoutExpired:
+        return None, f"TIMEOUT after {timeout}s"
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def split_semgrep_output(parsed, root):
+    """Group a multi-file semgrep result by target path (relative to root) into per-file results;
+    files semgrep neither scanned nor reported on are left out"""
+    by_file = defaultdict(lambda: {"version": parsed.get("version"), "results": [], "errors": []})
+    for path in parsed.get("paths", {}).get("scanned", []):
+        by_file[os.path.relpath(path, root)]
+    for finding in parsed.get("results", []):
+        by_file[os.path.relpath(finding.get("path", ""), root)]["results"].append(finding)
+    for error in parsed.get("errors", []):
+        if error.get("path"):
+            by_file[os.path.relpath(error["path"], root)]["errors"].append(error)
+    return dict(by_file)
+
+
+def iter_jsonl_lines(f, chunk_size=1 << 20, tee=None):
+    """Yield raw lines from a binary JSONL file, reading it in large blocks (optionally copied to tee)"""
+    buf = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        if tee is not None:
+            tee.write(chunk)
+        buf += chunk
+        start = 0
+        while (nl := buf.find(b"\n", start)) != -1:
+            yield buf[start:nl]
+            start = nl + 1
+        buf = buf[start:]
+    if buf:
+        yield buf
+
+
+def is_trivial_snippet(code):
+    """True when a snippet is empty once comments and using directives are removed"""
+    return len(TRIVIAL_CODE_RE.sub("", code).strip()) < 20
+
+
+@functools.lru_cache(maxsize=1)
+def semgrep_version():
+    """semgrep --version output (b"" if it can't be run)"""
+    try:
+        return subprocess.run(["semgrep", "--version"], capture_output=True, timeout=60).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        return b""
+
+
+def _hash_rule_files(h, path):
+    """Feed a rule file, or every file under a rule directory, into hash h"""
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        paths = [path]
+    for rule_path in paths:
+        h.update(b"|" + rule_path.encode())
+        with open(rule_path, "rb") as f:
+            h.update(f.read())
+
+
+def compute_rules_hash(custom_config=None, rules_cache_dir=None):
+    """Fingerprint the active rule set: semgrep version, plus registry snapshots and custom
+    rule files hashed by content"""
+    h = hashlib.sha256(orjson.dumps(custom_config or {}, option=orjson.OPT_SORT_KEYS))
+    h.update(semgrep_version())
+    for config in DEFAULT_SEMGREP_CONFIGS:
+        h.update(b"|" + config.encode())
+        if rules_cache_dir and os.path.exists(cached_rules_path(config, rules_cache_dir)):
+            _hash_rule_files(h, cached_rules_path(config, rules_cache_dir))
+    config_paths = (custom_config or {}).get("--config", [])
+    if isinstance(config_paths, str):
+        config_paths = [config_paths]
+    for config_path in config_paths:
+        if os.path.exists(config_path):
+            _hash_rule_files(h, config_path)
+    return h.hexdigest()[:16]
+
+
+def _cache_path(rules_hash, code_hash):
+    return os.path.join(RESULT_CACHE_DIR, rules_hash, f"{code_hash}.json.gz")
+
+
+def load_cached_result(rules_hash, code_hash):
+    """Return the cached semgrep result for a snippet, or None on a miss"""
+    try:
+        with gzip.open(_cache_path(rules_hash, code_hash), "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_result(rules_hash, code_hash, result):
+    path = _cache_path(rules_hash, code_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path + ".tmp", "wb") as f:
+        f.write(orjson.dumps(result))
+    os.replace(path + ".tmp", path)
+
+
+def scan_fingerprint(jsonl_path, max_snippets=None, rules_hash=None, edge=64 << 10):
+    """Cheap identity of a scan's inputs: file path, size, mtime and a hash of the file's
+    first and last 64 KiB, plus the snippet limit and rule set"""
+    st = os.stat(jsonl_path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(jsonl_path, "rb") as f:
+        h.update(f.read(edge))
+        if st.st_size > edge:
+            f.seek(max(edge, st.st_size - edge))
+            h.update(f.read(edge))
+    return [os.path.abspath(jsonl_path), st.st_size, st.st_mtime_ns, h.hexdigest(), max_snippets, rules_hash]
+
+
+def _scan_cache_paths(cache_dir, stage, vuln_type):
+    base = os.path.join(cache_dir, f"{stage}_{vuln_type}")
+    return base + ".meta.json", base + ".json.gz"
+
+
+def load_cached_scan(cache_dir, stage, vuln_type, fingerprint):
+    """Return the stored scan result for (stage, vuln_type) if its fingerprint matches, else None"""
+    meta_path, data_path = _scan_cache_paths(cache_dir, stage, vuln_type)
+    try:
+        with open(meta_path, "rb") as f:
+            if orjson.loads(f.read()) != fingerprint:
+                return None
+        with gzip.open(data_path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_scan(cache_dir, stage, vuln_type, fingerprint, data):
+    meta_path, data_path = _scan_cache_paths(cache_dir, stage, vuln_type)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Drop the old fingerprint first so it can never vouch for a half-replaced result
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    with gzip.open(data_path + ".tmp", "wb") as f:
+        f.write(orjson.dumps(data))
+    os.replace(data_path + ".tmp", data_path)
+    with open(meta_path + ".tmp", "wb") as f:
+        f.write(orjson.dumps(fingerprint))
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def local_copy_path(jsonl_path, output_dir, run_label, vuln_type, timestamp):
+    """Path of the timestamped snapshot of jsonl_path kept in the scan folder"""
+    base_name = f"{vuln_type}_{os.path.basename(jsonl_path).replace('.jsonl', '')}_{run_label}_{timestamp}.jsonl"
+    return os.path.join(output_dir, base_name)
+
+
+def prepare_jsonl_scan(jsonl_path, output_dir, run_label, vuln_type, target_dir, custom_config=None, max_snippets=None, rules_hash=None):
+    """Read a JSONL file and write the snippets that still need semgrep into target_dir
+    (rules_hash keys the per-snippet result cache; None disables it)"""
+    use_cache = rules_hash is not None
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # Create a timestamped local copy with vuln type in name
-    base_name = f"{vuln_type}_{os.path.basename(jsonl_path).replace('.jsonl', '')}_{run_label}_{timestamp}.jsonl"
-    local_copy = os.path.join(output_dir, base_name)
-    shutil.copy2(jsonl_path, local_copy)
-    print(f"Local copy created: {local_copy}")
+    local_copy = local_copy_path(jsonl_path, output_dir, run_label, vuln_type, timestamp)
 
-    all_results = []
-    total_snippets = total_lines = total_findings = 0
-    severity_counts = defaultdict(int)
-    rule_counts = defaultdict(int)
+    total_lines = 0
 
     print(f"Scanning file: {jsonl_path}")
     if custom_config:
         print(f"  Using custom semgrep rules")
     
-    snippet_count = 0
+    snippets = {}
+    precomputed = {}  # cache hits and trivial snippets, which never reach semgrep
+    first_by_hash = {}  # code hash -> filename of its first occurrence
+    duplicates = {}  # filename -> filename of an earlier snippet with identical code
+    cache_hits = skipped_empty = 0
     
-    with open(jsonl_path) as f:
-        for line in f:
-            if max_snippets and snippet_count >= max_snippets:
+    # The local copy is written from the same blocks the parser reads
+    with open(jsonl_path, "rb") as f, open(local_copy, "wb") as copy_f:
+        for line in iter_jsonl_lines(f, tee=copy_f):
+            if max_snippets and len(snippets) >= max_snippets:
                 break
+            # Cheap byte check so records without a response are never decoded
+            if b'"response"' not in line:
+                continue
             try:
-                obj = json.loads(line)
+                obj = orjson.loads(line)
                 code = obj.get("response")
                 if not code:
                     continue
@@ -89,81 +366,117 @@ def scan_jsonl_file(jsonl_path, output_dir, run_label, vuln_type, custom_config=
                 # Strip markdown code fences if present
                 code = code.strip()
                 if code.startswith("```"):
-                    lines = code.split("\n")
-                    lines = lines[1:]
-                    if lines and lines[-1].strip() == "```":
-                        lines = lines[:-1]
-                    code = "\n".join(lines)
+                    code = FENCE_RE.match(code).group("body")
                 
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 continue
             
-            snippet_count += 1
-            total_snippets += 1
-            total_lines += len(code.splitlines())
-
-            with tempfile.NamedTemporaryFile("w", suffix=".cs", delete=False) as tmp:
-                tmp.write(code)
-                tmp_path = tmp.name
+            snippet_index = len(snippets) + 1
+            filename = f"snippet_{snippet_index:05d}.cs"
+            code_hash = hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+            line_count = code.count("\n") + (1 if code and not code.endswith("\n") else 0)
+            snippets[filename] = (snippet_index, obj.get("prompt", ""), code, code_hash, line_count)
+            total_lines += line_count
             
-            try:
-                print(f"  Snippet {snippet_count}: scanning... (code lines: {len(code.splitlines())})", end="", flush=True)
-                
-                # Build command with custom configs
-                cmd = build_semgrep_command(tmp_path, custom_config)
-                
-                result = subprocess.run(
-                    cmd,
-                    capture_output=True, text=True, timeout=60
-                )
-                
-                os.unlink(tmp_path)
+            if code_hash in first_by_hash:
+                duplicates[filename] = first_by_hash[code_hash]
+                continue
+            first_by_hash[code_hash] = filename
+            if is_trivial_snippet(code):
+                precomputed[filename] = {"version": None, "results": [], "errors": []}
+                skipped_empty += 1
+                continue
+            cached_result = load_cached_result(rules_hash, code_hash) if use_cache else None
+            if cached_result is not None:
+                precomputed[filename] = cached_result
+                cache_hits += 1
+                continue
+            with open(os.path.join(target_dir, filename), "w") as tmp:
+                tmp.write(code)
+        
+        # Finish the copy when max_snippets stopped parsing early
+        shutil.copyfileobj(f, copy_f)
+    print(f"Local copy created: {local_copy}")
 
-                if result.returncode not in [0, 1]:
-                    print(f" → semgrep error (code {result.returncode})")
-                    if result.stderr:
-                        print(f"    stderr: {result.stderr[:300]}")
-                    continue
-                
-                if not result.stdout.strip():
-                    print(f" → empty output")
-                    continue
+    if duplicates:
+        print(f"  {len(duplicates)} duplicate snippets reuse an earlier snippet's result")
+    if skipped_empty:
+        print(f"  {skipped_empty} snippets skipped (only comments/using directives)")
+    if cache_hits:
+        print(f"  {cache_hits} snippets served from cache ({RESULT_CACHE_DIR})")
 
-                parsed = json.loads(result.stdout)
-                parsed["source_file"] = jsonl_path
-                parsed["snippet_index"] = snippet_count
-                parsed["prompt"] = obj.get("prompt", "")
-                parsed["code"] = code
-                
-                findings = parsed.get("results", [])
-                total_findings += len(findings)
-                
-                for finding in findings:
-                    severity = finding.get("extra", {}).get("severity", "unknown")
-                    severity_counts[severity] += 1
-                    rule_id = finding.get("check_id", "unknown")
-                    rule_counts[rule_id] += 1
-                
-                all_results.append(parsed)
-                print(f" → {len(findings)} findings")
-                
-            except subprocess.TimeoutExpired:
-                if os.path.exists(tmp_path):
-                    os.unlink(tmp_path)
-                print(f" → TIMEOUT after 60s")
-            except Exception as e:
-                if os.path.exists(tmp_path):
-                    os.unlink(tmp_path)
-                print(f" → error: {e}")
+    return {
+        "jsonl_path": jsonl_path,
+        "run_label": run_label,
+        "vuln_type": vuln_type,
+        "timestamp": timestamp,
+        "custom_config": custom_config,
+        "use_cache": use_cache,
+        "rules_hash": rules_hash,
+        "snippets": snippets,
+        "precomputed": precomputed,
+        "duplicates": duplicates,
+        "skipped_empty": skipped_empty,
+        "total_lines": total_lines,
+        "to_scan": len(snippets) - len(precomputed) - len(duplicates),
+    }
 
+
+def finish_jsonl_scan(scan, by_file):
+    """Merge semgrep's per-file results into a {"results", "stats"} scan result"""
+    snippets, precomputed, duplicates = scan["snippets"], scan["precomputed"], scan["duplicates"]
+    custom_config = scan["custom_config"]
+    
+    all_results = []
+    total_findings = 0
+    severity_counts = Counter()
+    rule_counts = Counter()
+
+    # Per-snippet progress is collected and written once rather than printed line by line
+    progress_lines = []
+    for filename, (snippet_index, prompt, code, code_hash, line_count) in snippets.items():
+        source = duplicates.get(filename, filename)
+        if source in precomputed:
+            snippet_result = precomputed[source]
+        else:
+            snippet_result = by_file.get(source)
+            if snippet_result is None:
+                # Never mentioned by semgrep: an unknown outcome, not "no findings"
+                snippet_result = {"version": None, "results": [], "errors": [
+                    {"type": "NotScanned", "level": "warn", "message": "semgrep did not report on this file"}
+                ]}
+            # A file semgrep errored on (timeout, parse failure) may have missed findings
+            if scan["use_cache"] and source == filename and not snippet_result["errors"]:
+                store_cached_result(scan["rules_hash"], code_hash, snippet_result)
+        if source != filename:
+            # Identical code: replay the first occurrence's findings under this snippet's index
+            snippet_result = dict(snippet_result)
+        snippet_result["paths"] = {"scanned": [filename]}
+        snippet_result["source_file"] = scan["jsonl_path"]
+        snippet_result["snippet_index"] = snippet_index
+        snippet_result["prompt"] = prompt
+        snippet_result["code"] = code
+        
+        findings = snippet_result["results"]
+        total_findings += len(findings)
+        
+        severity_counts.update(finding.get("extra", {}).get("severity", "unknown") for finding in findings)
+        rule_counts.update(finding.get("check_id", "unknown") for finding in findings)
+        
+        all_results.append(snippet_result)
+        progress_lines.append(f"  Snippet {snippet_index}: → {len(findings)} findings (code lines: {line_count})\n")
+    sys.stdout.write("".join(progress_lines))
+
+    total_snippets = len(scan["snippets"])
     return {
         "results": all_results,
         "stats": {
-            "label": run_label,
-            "vuln_type": vuln_type,
-            "timestamp": timestamp,
+            "label": scan["run_label"],
+            "vuln_type": scan["vuln_type"],
+            "timestamp": scan["timestamp"],
             "total_snippets": total_snippets,
-            "total_lines": total_lines,
+            "skipped_empty": scan["skipped_empty"],
+            "total_lines": scan["total_lines"],
             "total_findings": total_findings,
             "severity_counts": dict(severity_counts),
             "rule_counts": dict(rule_counts),
@@ -173,6 +486,104 @@ def scan_jsonl_file(jsonl_path, output_dir, run_label, vuln_type, custom_config=
     }
 
 
+def scan_jsonl_targets(paths_by_target, output_dir, max_snippets=None, use_cache=True, custom_config=None, rules_cache_dir=None):
+    """Scan JSONL files keyed by (stage, vuln_type) in a single semgrep run, so rules are
+    loaded and compiled once; returns {(stage, vuln_type): {"results", "stats"}}"""
+    # Files whose fingerprint matches the last scan reuse its result; the cache lives
+    # beside the timestamped scan folders
+    scan_cache_dir = os.path.join(os.path.dirname(output_dir), ".scan_cache")
+    rules_hash = compute_rules_hash(custom_config, rules_cache_dir) if use_cache else None
+    results = {}
+    fingerprints = {}
+
+    # One aggregate counter across every (stage, vuln_type) pair instead of per-step banners
+    def progress(target, note):
+        sys.stdout.write(f"[{len(results)}/{len(paths_by_target)}] Semgrep scans: {target[0]} {target[1]} {note}\n")
+        sys.stdout.flush()
+
+    # One <stage>/<vuln_type> subdirectory per file, so findings demux back by relative path;
+    # on Linux keep it in /dev/shm so the snippet files never touch the disk
+    tmp_dir = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        scans = {}
+        for (stage, vuln_type), jsonl_path in paths_by_target.items():
+            if use_cache:
+                fingerprints[stage, vuln_type] = scan_fingerprint(jsonl_path, max_snippets, rules_hash)
+                cached = load_cached_scan(scan_cache_dir, stage, vuln_type, fingerprints[stage, vuln_type])
+                if cached is not None:
+                    # The scan folder still gets its snapshot of the input, and the reused
+                    # stats are restamped with this run's time
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    shutil.copyfile(jsonl_path, local_copy_path(jsonl_path, output_dir, stage, vuln_type, timestamp))
+                    cached["stats"]["timestamp"] = timestamp
+                    results[stage, vuln_type] = cached
+                    progress((stage, vuln_type), f"reused ({jsonl_path} unchanged)")
+                    continue
+            target_dir = os.path.join(tmp_dir, stage, vuln_type)
+            os.makedirs(target_dir)
+            scans[stage, vuln_type] = prepare_jsonl_scan(
+                jsonl_path, output_dir, stage, vuln_type, target_dir, custom_config, max_snippets, rules_hash
+            )
+        semgrep_results = {}  # (stage, vuln_type) -> {filename: semgrep result for that file}
+        to_scan = sum(scan["to_scan"] for scan in scans.values())
+        if to_scan:
+            print(f"  Scanning {to_scan} snippets from {len(scans)} files in one semgrep run...", flush=True)
+            parsed, message = run_semgrep(tmp_dir, custom_config, min(SEMGREP_TIMEOUT * to_scan, SEMGREP_MAX_RUN_TIMEOUT), rules_cache_dir)
+            if parsed is not None:
+                by_file = split_semgrep_output(parsed, tmp_dir)
+                for target, scan in scans.items():
+                    semgrep_results[target] = {filename: by_file.get(os.path.join(*target, filename)) for filename in scan["snippets"]}
+            else:
+                # Retry file by file so one bad input doesn't take the whole batch down with it
+                print(f"  → {message}, retrying each file in its own semgrep run", flush=True)
+                failures = []
+                for target, scan in scans.items():
+                    if not scan["to_scan"]:
+                        continue
+                    target_dir = os.path.join(tmp_dir, *target)
+                    parsed, message = run_semgrep(target_dir, custom_config, min(SEMGREP_TIMEOUT * scan["to_scan"], SEMGREP_MAX_RUN_TIMEOUT), rules_cache_dir)
+                    if parsed is None:
+                        failures.append(f"{target[0]} {target[1]} ({scan['jsonl_path']}): {message}")
+                        continue
+                    by_file = split_semgrep_output(parsed, target_dir)
+                    semgrep_results[target] = {filename: by_file.get(filename) for filename in scan["snippets"]}
+                if failures:
+                    # A comparison built from a failed scan would report missing findings as fixed
+                    raise RuntimeError("semgrep failed for:\n    " + "\n    ".join(failures))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for target, scan in scans.items():
+        results[target] = finish_jsonl_scan(scan, semgrep_results.get(target, {}))
+        # Only a clean scan is replayed; any snippet semgrep errored on may have missed findings
+        if use_cache and not any(result["errors"] for result in results[target]["results"]):
+            store_cached_scan(scan_cache_dir, *target, fingerprints[target], results[target])
+        progress(target, f"→ {results[target]['stats']['total_findings']} findings")
+    return results
+
+
+def build_comparison_record(before_data, after_fixing_data, after_fine_tuning_data, vuln_type):
+    """Build the three-way comparison data for one vulnerability (one all_reports.jsonl record)"""
+    before_findings = before_data["stats"]["total_findings"]
+    fixing_findings = after_fixing_data["stats"]["total_findings"]
+    tuning_findings = after_fine_tuning_data["stats"]["total_findings"]
+
+    def change(old, new):
+        return {"findings": new - old, "findings_pct": ((new - old) / old * 100) if old > 0 else 0}
+
+    return {
+        "vuln_type": vuln_type,
+        "before": before_data,
+        "after_fixing": after_fixing_data,
+        "after_fine_tuning": after_fine_tuning_data,
+        "comparison_timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+        "changes": {
+            "raw_to_fixing": change(before_findings, fixing_findings),
+            "fixing_to_tuning": change(fixing_findings, tuning_findings),
+            "raw_to_tuning_overall": change(before_findings, tuning_findings)
+        }
+    }
+
 
 def generate_comparison_report(before_data, after_fixing_data, after_fine_tuning_data, output_dir, vuln_type):
     """Generate HTML comparison report with three-way comparison"""
@@ -238,7 +649,7 @@ def generate_comparison_report(before_data, after_fixing_data, after_fine_tuning
         c2_str = f"<span style='color:{'red' if c2 > 0 else 'green'}'>{c2:+d}</span>" if c2 != 0 else "0"
         c3_str = f"<span style='color:{'red' if c3 > 0 else 'green'}'>{c3:+d}</span>" if c3 != 0 else "0"
         
-        severity_rows.append(f"<tr><td>{html.escape(severity)}</td><td>{b}</td><td>{f}</td><td>{t}</td><td>{c1_str}</td><td>{c2_str}</td><td>{c3_str}</td></tr>")
+        severity_rows.append(f"<tr><td>{_esc_cached(severity)}</td><td>{b}</td><td>{f}</td><td>{t}</td><td>{c1_str}</td><td>{c2_str}</td><td>{c3_str}</td></tr>")
     
     # Top rules table
     all_rules = set(before_stats["rule_counts"].keys()) | set(after_fixing_stats["rule_counts"].keys()) | set(after_fine_tuning_stats["rule_counts"].keys())
@@ -255,7 +666,7 @@ def generate_comparison_report(before_data, after_fixing_data, after_fine_tuning
         c1_str = f"<span style='color:{'red' if c1 > 0 else 'green'}'>{c1:+d}</span>" if c1 != 0 else "0"
         c2_str = f"<span style='color:{'red' if c2 > 0 else 'green'}'>{c2:+d}</span>" if c2 != 0 else "0"
         c3_str = f"<span style='color:{'red' if c3 > 0 else 'green'}'>{c3:+d}</span>" if c3 != 0 else "0"
-        rule_rows.append(f"<tr><td>{html.escape(rule)}</td><td>{b}</td><td>{f}</td><td>{t}</td><td>{c1_str}</td><td>{c2_str}</td><td>{c3_str}</td></tr>")
+        rule_rows.append(f"<tr><td>{_esc_cached(rule)}</td><td>{b}</td><td>{f}</td><td>{t}</td><td>{c1_str}</td><td>{c2_str}</td><td>{c3_str}</td></tr>")
     
     # Detailed findings tables
     def group_by_snippet(findings):
@@ -264,57 +675,63 @@ def generate_comparison_report(before_data, after_fixing_data, after_fine_tuning
             grouped[f["snippet_idx"]].append(f)
         return grouped
     
-    def create_detail_rows(by_snippet, stage_id):
-        rows = []
+    def iter_detail_rows(by_snippet, stage_id):
+        _esc = html.escape
         for snippet_idx in sorted(by_snippet.keys()):
             findings = by_snippet[snippet_idx]
             prompt = findings[0]["prompt"] if findings else ""
+            # The snippet link and prompt cells span all of the snippet's rows
+            rowspan = len(findings)
+            link = SNIPPET_LINK_TMPL.format(stage_id=stage_id, snippet_idx=snippet_idx)
+            snippet_cell = SNIPPET_CELL_TMPL.format(rowspan=rowspan, link=link)
+            prompt_cell = PROMPT_CELL_TMPL.format(rowspan=rowspan, prompt=_esc(prompt[:80] + '...' if len(prompt) > 80 else prompt))
             for i, f in enumerate(findings):
-                sev_color = {"ERROR": "#d32f2f", "WARNING": "#f57c00", "INFO": "#1976d2"}.get(f["severity"], "#666")
-                link = f'<a href="#" onclick="showSnippet(\'{stage_id}\', {snippet_idx}); return false;" style="color:#2196F3;text-decoration:underline;font-weight:bold">#{snippet_idx}</a>'
-                rows.append(f"""<tr>
-                  {'<td rowspan="' + str(len(findings)) + '">' + link + '</td>' if i == 0 else ''}
-                  {'<td rowspan="' + str(len(findings)) + '" style="font-size:12px">' + html.escape(prompt[:80] + '...' if len(prompt) > 80 else prompt) + '</td>' if i == 0 else ''}
-                  <td><span style="background:{sev_color};color:white;padding:2px 8px;border-radius:3px;font-size:11px">{html.escape(f["severity"])}</span></td>
-                  <td style="font-size:12px">{html.escape(f["rule"])}</td>
-                  <td>{f["line"]}</td>
-                  <td style="font-size:12px">{html.escape(f["message"][:120] + '...' if len(f["message"]) > 120 else f["message"])}</td>
-                </tr>""")
-        return rows
+                message = f["message"]
+                yield DETAIL_ROW_TMPL.format_map({
+                    "snippet_cell": snippet_cell if i == 0 else "",
+                    "prompt_cell": prompt_cell if i == 0 else "",
+                    "sev_color": SEV_COLORS.get(f["severity"], "#666"),
+                    "severity": _esc_cached(f["severity"]),
+                    "rule": _esc_cached(f["rule"]),
+                    "line": f["line"],
+                    "message": _esc(message[:120] + '...' if len(message) > 120 else message),
+                })
     
     before_by_snippet = group_by_snippet(findings_before)
     fixing_by_snippet = group_by_snippet(findings_fixing)
     tuning_by_snippet = group_by_snippet(findings_tuning)
     
-    detailed_rows_before = create_detail_rows(before_by_snippet, "before")
-    detailed_rows_fixing = create_detail_rows(fixing_by_snippet, "fixing")
-    detailed_rows_tuning = create_detail_rows(tuning_by_snippet, "tuning")
-    
     # Custom rules info badge
     custom_rules_badge = ""
     custom_rules_count = before_stats.get("custom_rules_used", 0)
     if custom_rules_count > 0:
         custom_rules_badge = f'<span class="vuln-badge" style="background:#9C27B0">+ {custom_rules_count} Custom Rules</span>'
     
-    # CRITICAL FIX: Use base64 encoding to completely avoid escape sequence issues
-    import base64
-    snippets_before_b64 = base64.b64encode(json.dumps(snippets_before).encode('utf-8')).decode('ascii')
-    snippets_fixing_b64 = base64.b64encode(json.dumps(snippets_fixing).encode('utf-8')).decode('ascii')
-    snippets_tuning_b64 = base64.b64encode(json.dumps(snippets_tuning).encode('utf-8')).decode('ascii')
-    
-    # Debug: verify encoding
-    print(f"DEBUG: Base64 lengths - before:{len(snippets_before_b64)}, fixing:{len(snippets_fixing_b64)}, tuning:{len(snippets_tuning_b64)}")
+    # Snippet code goes into sibling JSON files that the page fetches on the first snippet click
+    snippet_urls = {}
+    for stage_id, snippets in (("before", snippets_before), ("fixing", snippets_fixing), ("tuning", snippets_tuning)):
+        snippets_name = f"{vuln_type}_snippets_{stage_id}_{timestamp}.json"
+        with open(os.path.join(output_dir, snippets_name), "wb") as f:
+            f.write(orjson.dumps(snippets))
+        snippet_urls[stage_id] = snippets_name
     
-    # Build the script section - using base64 encoded data
     script_data_section = f"""<script>
-// BASE64 SOLUTION v2 - Decode base64 JSON data - this completely bypasses all escape sequence issues
-const snippetsBefore = JSON.parse(atob('{snippets_before_b64}'));
-const snippetsFixing = JSON.parse(atob('{snippets_fixing_b64}'));
-const snippetsTuning = JSON.parse(atob('{snippets_tuning_b64}'));
-console.log('Snippets loaded via base64:', Object.keys(snippetsBefore).length, 'before,', Object.keys(snippetsFixing).length, 'fixing,', Object.keys(snippetsTuning).length, 'tuning');
+const SNIPPET_URLS = {orjson.dumps(snippet_urls).decode()};
+const snippetCache = {{}};
+function loadSnippets(type) {{
+  if (!snippetCache[type]) {{
+    snippetCache[type] = fetch(SNIPPET_URLS[type])
+      .then(r => {{ if (!r.ok) throw new Error(r.status + ' ' + r.statusText); return r.json(); }})
+      .catch(err => {{ delete snippetCache[type]; throw err; }});  // let the next click retry
+  }}
+  return snippetCache[type];
+}}
 </script>"""
     
-    html_report = f"""<!DOCTYPE html>
+    report_path = os.path.join(output_dir, f"{vuln_type}_comparison_report_{timestamp}.html")
+    # Stream the report section by section instead of assembling one giant string
+    with open(report_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+        f.write(f"""<!DOCTYPE html>
 <html><head><meta charset="UTF-8"><title>Semgrep Analysis - {html.escape(vuln_type)}</title><style>
 body{{font-family:sans-serif;margin:20px;background:#f5f5f5}}
 .container{{max-width:1600px;margin:0 auto;background:white;padding:30px;border-radius:8px;box-shadow:0 2px 4px rgba(0,0,0,0.1)}}
@@ -354,7 +771,9 @@ code{{font-family:'Courier New',monospace;font-size:13px}}
 .comparison-box{{background:#fff3cd;padding:15px;border-radius:5px;margin:10px 0;border-left:4px solid:#ffc107}}
 .comparison-box h4{{margin:0 0 10px 0;color:#856404}}
 </style>
-{script_data_section}
+""")
+        f.write(script_data_section)
+        f.write(f"""
 <script>
 
 function showTab(tabName) {{
@@ -371,12 +790,19 @@ function escapeHtml(text) {{
 }}
 
 function showSnippet(type, idx) {{
-  let snippets, stageLabel;
-  if (type === 'before') {{ snippets = snippetsBefore; stageLabel = 'Raw/Before'; }}
-  else if (type === 'fixing') {{ snippets = snippetsFixing; stageLabel = 'After Fixing'; }}
-  else {{ snippets = snippetsTuning; stageLabel = 'After Fine-Tuning'; }}
+  loadSnippets(type)
+    .then(snippets => renderSnippet(type, idx, snippets[idx]))
+    .catch(err => alert(location.protocol === 'file:'
+      ? 'Snippets are loaded on demand and browsers block that for file:// pages - open this report through serve mode (python test_with_semgrep.py serve)'
+      : 'Could not load snippets from ' + SNIPPET_URLS[type] + ' (' + err.message + ')'));
+}}
+
+function renderSnippet(type, idx, snippet) {{
+  let stageLabel;
+  if (type === 'before') {{ stageLabel = 'Raw/Before'; }}
+  else if (type === 'fixing') {{ stageLabel = 'After Fixing'; }}
+  else {{ stageLabel = 'After Fine-Tuning'; }}
   
-  const snippet = snippets[idx];
   if (!snippet) {{ alert('Snippet not found'); return; }}
   
   const modal = document.getElementById('snippetModal');
@@ -448,14 +874,24 @@ window.onclick = function(event) {{
 <table>
 <tr><th rowspan="2">Severity</th><th colspan="3">Counts</th><th colspan="3">Changes</th></tr>
 <tr><th>Raw</th><th>Fixed</th><th>Fine-Tuned</th><th>Raw→Fixed</th><th>Fixed→Tuned</th><th>Raw→Tuned</th></tr>
-{''.join(severity_rows) if severity_rows else '<tr><td colspan="7" style="text-align:center">No data</td></tr>'}
+""")
+        if severity_rows:
+            f.writelines(severity_rows)
+        else:
+            f.write('<tr><td colspan="7" style="text-align:center">No data</td></tr>')
+        f.write("""
 </table>
 
 <h3>🎯 Top Security Rules</h3>
 <table>
 <tr><th rowspan="2">Rule ID</th><th colspan="3">Counts</th><th colspan="3">Changes</th></tr>
 <tr><th>Raw</th><th>Fixed</th><th>Fine-Tuned</th><th>Raw→Fixed</th><th>Fixed→Tuned</th><th>Raw→Tuned</th></tr>
-{''.join(rule_rows) if rule_rows else '<tr><td colspan="7" style="text-align:center">No data</td></tr>'}
+""")
+        if rule_rows:
+            f.writelines(rule_rows)
+        else:
+            f.write('<tr><td colspan="7" style="text-align:center">No data</td></tr>')
+        f.write("""
 </table>
 
 <h3>🔍 Detailed Findings</h3>
@@ -468,21 +904,36 @@ window.onclick = function(event) {{
 <div id="before-details" class="tab-content active">
   <table>
     <tr><th>Snippet</th><th>Prompt</th><th>Severity</th><th>Rule</th><th>Line</th><th>Message</th></tr>
-    {''.join(detailed_rows_before) if detailed_rows_before else '<tr><td colspan="6" style="text-align:center;color:#4CAF50">✓ No findings</td></tr>'}
+    """)
+        if before_by_snippet:
+            f.writelines(iter_detail_rows(before_by_snippet, "before"))
+        else:
+            f.write('<tr><td colspan="6" style="text-align:center;color:#4CAF50">✓ No findings</td></tr>')
+        f.write("""
   </table>
 </div>
 
 <div id="fixing-details" class="tab-content">
   <table>
     <tr><th>Snippet</th><th>Prompt</th><th>Severity</th><th>Rule</th><th>Line</th><th>Message</th></tr>
-    {''.join(detailed_rows_fixing) if detailed_rows_fixing else '<tr><td colspan="6" style="text-align:center;color:#4CAF50">✓ No findings</td></tr>'}
+    """)
+        if fixing_by_snippet:
+            f.writelines(iter_detail_rows(fixing_by_snippet, "fixing"))
+        else:
+            f.write('<tr><td colspan="6" style="text-align:center;color:#4CAF50">✓ No findings</td></tr>')
+        f.write("""
   </table>
 </div>
 
 <div id="tuning-details" class="tab-content">
   <table>
     <tr><th>Snippet</th><th>Prompt</th><th>Severity</th><th>Rule</th><th>Line</th><th>Message</th></tr>
-    {''.join(detailed_rows_tuning) if detailed_rows_tuning else '<tr><td colspan="6" style="text-align:center;color:#4CAF50">✓ No findings</td></tr>'}
+    """)
+        if tuning_by_snippet:
+            f.writelines(iter_detail_rows(tuning_by_snippet, "tuning"))
+        else:
+            f.write('<tr><td colspan="6" style="text-align:center;color:#4CAF50">✓ No findings</td></tr>')
+        f.write(f"""
   </table>
 </div>
 
@@ -518,45 +969,34 @@ window.onclick = function(event) {{
   </div>
 </div>
 
-</body></html>"""
+</body></html>""")
     
-    report_path = os.path.join(output_dir, f"{vuln_type}_comparison_report_{timestamp}.html")
-    with open(report_path, "w", encoding="utf-8") as f:
-        f.write(html_report)
-    
-    json_path = os.path.join(output_dir, f"{vuln_type}_comparison_data_{timestamp}.json")
-    with open(json_path, "w") as f:
-        json.dump({
-            "vuln_type": vuln_type,
-            "before": before_data,
-            "after_fixing": after_fixing_data,
-            "after_fine_tuning": after_fine_tuning_data,
-            "comparison_timestamp": timestamp,
-            "changes": {
-                "raw_to_fixing": {"findings": findings_change_fixing, "findings_pct": findings_change_fixing_pct},
-                "fixing_to_tuning": {"findings": findings_change_tuning, "findings_pct": findings_change_tuning_pct},
-                "raw_to_tuning_overall": {"findings": findings_change_overall, "findings_pct": findings_change_overall_pct}
-            }
-        }, f, indent=2)
-    
-    return report_path, json_path
+    return report_path
 
 def serve_reports(base_dir="semgrep_results", port=5050):
    """Serve all scan folders and their reports for browsing."""
+   base_dir = os.path.abspath(base_dir)  # send_from_directory resolves relative paths against the script, not the cwd
    app = Flask(__name__)
 
+   @functools.lru_cache(maxsize=1)
+   def list_reports(time_bucket):
+      """List (scan folder, report names) pairs; a new time_bucket forces a fresh listing"""
+      with os.scandir(base_dir) as it:
+         scans = sorted((e.path for e in it if e.is_dir() and e.name.startswith("scan_")), reverse=True)
+      listing = []
+      for scan_dir in scans:
+         with os.scandir(scan_dir) as it:
+            reports = sorted((e.name for e in it if fnmatch.fnmatchcase(e.name, "*_comparison_report_*.html")), reverse=True)
+         listing.append((os.path.relpath(scan_dir, base_dir), reports))
+      return listing
+
    @app.route("/")
    def index():
-      scans = sorted(
-         [d for d in glob.glob(os.path.join(base_dir, "scan_*")) if os.path.isdir(d)],
-         reverse=True
-      )
       items = []
-      for scan_dir in scans:
-         reports = sorted(glob.glob(os.path.join(scan_dir, "*_comparison_report_*.html")), reverse=True)
-         rel = os.path.relpath(scan_dir, base_dir)
+      # Re-list the folders at most every 5 seconds
+      for rel, reports in list_reports(int(time.time() // 5)):
          links = "".join(
-            f"<li><a href='/report/{rel}/{os.path.basename(r)}'>{os.path.basename(r)}</a></li>"
+            f"<li><a href='/report/{rel}/{r}'>{r}</a></li>"
             for r in reports
          )
          items.append(f"<h3>📂 {rel}</h3><ul>{links or '<li><i>No reports</i></li>'}</ul>")
@@ -583,33 +1023,102 @@ def serve_reports(base_dir="semgrep_results", port=5050):
    threading.Thread(target=run_server, daemon=True).start()
    webbrowser.open(f"http://127.0.0.1:{port}")
 
-   """Start a small Flask server to browse and view reports interactively."""
-   app = Flask(__name__)
 
-   @app.route("/")
-   def index():
-      output_dir = "semgrep_results"
-      files = sorted(glob.glob(os.path.join(output_dir, "*_comparison_report_*.html")), reverse=True)
-      links = [f"<li><a href='/report/{os.path.basename(f)}'>{os.path.basename(f)}</a></li>" for f in files]
-      html = f"""
-      <html><head><title>Semgrep Reports</title></head>
-      <body style='font-family:sans-serif;padding:30px'>
-      <h2>📊 Available Reports ({len(files)})</h2>
-      <ul>{''.join(links)}</ul>
-      <p style='margin-top:20px;color:#555'>Serving directory: {output_dir}</p>
-      </body></html>
-      """
-      return render_template_string(html)
+def report_url(report_path, base_dir="semgrep_results", port=5050):
+    """URL of a report in the serve-mode viewer (reports fetch their snippets, so file:// won't do)"""
+    subdir = os.path.relpath(os.path.dirname(report_path), base_dir).replace(os.sep, "/")
+    return f"http://127.0.0.1:{port}/report/{subdir}/{os.path.basename(report_path)}"
 
-   @app.route("/report/<path:filename>")
-   def report(filename):
-      return send_from_directory(output_dir, filename)
 
-   def run_server():
-      print(f"\n🚀 Flask viewer running at http://127.0.0.1:{port}")
-      app.run(port=port, debug=False, use_reloader=False)
+def dispatch_scans(stage_triples, output_dir, max_snippets=None, use_cache=True, custom_config=None, rules_cache_dir=None):
+    """Scan {vuln_type: (before_path, fixed_path, fine_tuned_path)} in one semgrep run;
+    returns {vuln_type: (before_data, fixed_data, fine_tuned_data)}"""
+    results = scan_jsonl_targets(
+        {(stage, vuln_type): path for vuln_type, triple in stage_triples.items() for stage, path in zip(STAGES, triple)},
+        output_dir, max_snippets, use_cache, custom_config, rules_cache_dir
+    )
+    return {vuln_type: tuple(results[stage, vuln_type] for stage in STAGES) for vuln_type in stage_triples}
 
-   threading.Thread(target=run_server, daemon=True).start()
+
+def scan_all(config, output_dir, max_snippets=None, use_cache=True, write_html=True, custom_config=None, rules_cache_dir=None):
+    """Scan every stage of every vulnerability type in one semgrep run, then report each vulnerability"""
+    stage_triples = {vuln_type: tuple(paths[stage] for stage in STAGES) for vuln_type, paths in config.items()}
+    data_triples = dispatch_scans(stage_triples, output_dir, max_snippets, use_cache, custom_config, rules_cache_dir)
+
+    # All comparison data goes into one JSONL file, one record per vulnerability
+    with open(os.path.join(output_dir, "all_reports.jsonl"), "wb", buffering=1 << 20) as records_file:
+        return {
+            vuln_type: report_vulnerability(
+                vuln_type, *data_triples[vuln_type], output_dir, records_file, write_html
+            )
+            for vuln_type in config
+        }
+
+
+def report_vulnerability(vuln_type, before_data, after_fixing_data, after_fine_tuning_data, output_dir, records_file, write_html=True):
+    """Append the comparison record for one vulnerability to records_file, write its HTML report
+    (unless write_html is False) and print its summary"""
+    records_file.write(orjson.dumps(
+        build_comparison_record(before_data, after_fixing_data, after_fine_tuning_data, vuln_type),
+        option=orjson.OPT_APPEND_NEWLINE
+    ))
+    json_path = records_file.name
+
+    report_path = None
+    if write_html:
+        # Generate comparison report for this vulnerability
+        print(f"\nGenerating comparison report for {vuln_type}...")
+        report_path = generate_comparison_report(
+            before_data, 
+            after_fixing_data, 
+            after_fine_tuning_data, 
+            output_dir, 
+            vuln_type
+        )
+
+    # Look the stats up once for the result and the summary below
+    before_stats = before_data['stats']
+    fixing_stats = after_fixing_data['stats']
+    tuning_stats = after_fine_tuning_data['stats']
+    b = before_stats['total_findings']
+    f = fixing_stats['total_findings']
+    t = tuning_stats['total_findings']
+
+    # Store results
+    result = {
+        "report_path": report_path,
+        "json_path": json_path,
+        "before_findings": b,
+        "fixing_findings": f,
+        "tuning_findings": t
+    }
+
+    # Print summary for this vulnerability, collected and written in one go
+    summary_lines = [
+        f"\n{'='*60}\n",
+        f"✓ Report for {vuln_type} saved: {report_path}\n" if report_path else "",
+        f"✓ JSON data saved: {json_path}\n",
+        f"\n📊 Quick Summary for {vuln_type}:\n",
+        f"  Raw:        {b} findings ({before_stats['findings_per_snippet']:.2f} avg)\n",
+        f"  Fixed:      {f} findings ({fixing_stats['findings_per_snippet']:.2f} avg)\n",
+        f"  Fine-Tuned: {t} findings ({tuning_stats['findings_per_snippet']:.2f} avg)\n",
+    ]
+
+    change_fixing = f - b
+    change_tuning = t - f
+    change_overall = t - b
+
+    if b > 0:
+        summary_lines.append(f"  Raw → Fixed:      {change_fixing:+d} ({change_fixing/b*100:+.1f}%)\n")
+    if f > 0:
+        summary_lines.append(f"  Fixed → Tuned:    {change_tuning:+d} ({change_tuning/f*100:+.1f}%)\n")
+    if b > 0:
+        summary_lines.append(f"  Raw → Tuned:      {change_overall:+d} ({change_overall/b*100:+.1f}%)\n")
+    summary_lines.append(f"{'='*60}\n")
+    sys.stdout.write("".join(summary_lines))
+    sys.stdout.flush()
+
+    return result
 
 
 # ============= MAIN EXECUTION =============
@@ -619,7 +1128,9 @@ if __name__ == "__main__":
     parser.add_argument("mode", choices=["scan", "serve", "single"], help="scan: run full analysis, serve: launch report viewer")
     parser.add_argument("--out", default=None, help="output directory to serve or save results to")
     parser.add_argument("--port", type=int, default=5050, help="port for Flask server (serve mode)")
-    parser.add_argument("--custom", type=bool, default=False, help="custom semgrep rules")
+    parser.add_argument("--custom", default=None, metavar="CONFIG_JSON", help="custom semgrep config JSON listing extra --config rule paths")
+    parser.add_argument("--no-cache", action="store_true", help="ignore and don't update the per-snippet result cache")
+    parser.add_argument("--no-html", action="store_true", help="only write all_reports.jsonl, skip the HTML reports")
     args = parser.parse_args()
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -636,115 +1147,64 @@ if __name__ == "__main__":
         input("\nPress Enter to stop the server...\n")    
     else:
         os.makedirs(OUT_DIR, exist_ok=True)
+        
+        # Keep semgrep's metrics off the network; its own cache and settings (login token) stay where they are
+        os.environ["SEMGREP_SEND_METRICS"] = "off"
+        os.environ["SEMGREP_USER_AGENT_APPEND"] = "batch"
+        # Registry rule snapshots are shared across scans rather than fetched into each one
+        prefetch_registry_rules(REGISTRY_RULES_DIR)
         # Load configuration
         config = load_vuln_config()
         
-        # Load custom semgrep configuration
-        custom_config = load_custom_semgrep_config(CUSTOM_CONFIG_PATH)
+        # Custom semgrep rules are opt-in via --custom
+        custom_config = load_custom_semgrep_config(args.custom) if args.custom else None
         
         # Set to None to scan all snippets, or a number to limit
         MAX_SNIPPETS = 180  # Remove or set to None for full scan
 
         print("="*60)
         print("SEMGREP THREE-STAGE COMPARISON (PER VULNERABILITY)")
-        #if custom_config:
-        #    print(f"Using {len(custom_config.get('--config', []))} custom rule(s)")
         print("="*60)
 
-        all_results = {}
-
-        # Process each vulnerability type separately
-        for vuln_type, paths in config.items():
-            print(f"\n{'='*60}")
-            print(f"Processing vulnerability: {vuln_type.upper()}")
-            print(f"{'='*60}")
-            
-            before_path = paths["before"]
-            fixed_path = paths["fixed"]
-            fine_tuned_path = paths["fine_tuned"]
-
-            # Scan Stage 1: BEFORE
-            print(f"\n[1/4] Scanning BEFORE for {vuln_type}...")
-            #before_data = scan_jsonl_file(before_path, OUT_DIR, "before", vuln_type, custom_config, MAX_SNIPPETS)
-            before_data = scan_jsonl_file(before_path, OUT_DIR, "before", vuln_type, None, MAX_SNIPPETS)
-
-            # Scan Stage 2: AFTER FIXING
-            print(f"\n[2/4] Scanning AFTER FIXING for {vuln_type}...")
-            #after_fixing_data = scan_jsonl_file(fixed_path, OUT_DIR, "fixed", vuln_type, custom_config, MAX_SNIPPETS)
-            after_fixing_data = scan_jsonl_file(fixed_path, OUT_DIR, "fixed", vuln_type, None, MAX_SNIPPETS)
-
-            # Scan Stage 3: AFTER FINE-TUNING
-            print(f"\n[3/4] Scanning AFTER FINE-TUNING for {vuln_type}...")
-            #after_fine_tuning_data = scan_jsonl_file(fine_tuned_path, OUT_DIR, "fine_tuned", vuln_type, custom_config, MAX_SNIPPETS)
-            after_fine_tuning_data = scan_jsonl_file(fine_tuned_path, OUT_DIR, "fine_tuned", vuln_type, None, MAX_SNIPPETS)
-
-            # Generate comparison report for this vulnerability
-            print(f"\n[4/4] Generating comparison report for {vuln_type}...")
-            report_path, json_path = generate_comparison_report(
-                before_data, 
-                after_fixing_data, 
-                after_fine_tuning_data, 
-                OUT_DIR, 
-                vuln_type
-            )
+        try:
+            all_results = scan_all(config, OUT_DIR, MAX_SNIPPETS, use_cache=not args.no_cache, write_html=not args.no_html, custom_config=custom_config, rules_cache_dir=REGISTRY_RULES_DIR)
+        except RuntimeError as e:
+            print(f"\n✗ {e}\nNo comparison reports were written.")
+            exit(1)
 
-            # Store results
-            all_results[vuln_type] = {
-                "report_path": report_path,
-                "json_path": json_path,
-                "before_findings": before_data['stats']['total_findings'],
-                "fixing_findings": after_fixing_data['stats']['total_findings'],
-                "tuning_findings": after_fine_tuning_data['stats']['total_findings']
-            }
+        # Print overall summary, collected and written in one go
+        total_before = total_fixing = total_tuning = 0
+        for r in all_results.values():
+            total_before += r['before_findings']
+            total_fixing += r['fixing_findings']
+            total_tuning += r['tuning_findings']
 
-            # Print summary for this vulnerability
-            print(f"\n{'='*60}")
-            print(f"✓ Report for {vuln_type} saved: {report_path}")
-            print(f"✓ JSON data saved: {json_path}")
-            print(f"\n📊 Quick Summary for {vuln_type}:")
-            print(f"  Raw:        {before_data['stats']['total_findings']} findings ({before_data['stats']['findings_per_snippet']:.2f} avg)")
-            print(f"  Fixed:      {after_fixing_data['stats']['total_findings']} findings ({after_fixing_data['stats']['findings_per_snippet']:.2f} avg)")
-            print(f"  Fine-Tuned: {after_fine_tuning_data['stats']['total_findings']} findings ({after_fine_tuning_data['stats']['findings_per_snippet']:.2f} avg)")
-            
-            change_fixing = after_fixing_data['stats']['total_findings'] - before_data['stats']['total_findings']
-            change_tuning = after_fine_tuning_data['stats']['total_findings'] - after_fixing_data['stats']['total_findings']
-            change_overall = after_fine_tuning_data['stats']['total_findings'] - before_data['stats']['total_findings']
-            
-            if before_data['stats']['total_findings'] > 0:
-                print(f"  Raw → Fixed:      {change_fixing:+d} ({change_fixing/before_data['stats']['total_findings']*100:+.1f}%)")
-            if after_fixing_data['stats']['total_findings'] > 0:
-                print(f"  Fixed → Tuned:    {change_tuning:+d} ({change_tuning/after_fixing_data['stats']['total_findings']*100:+.1f}%)")
-            if before_data['stats']['total_findings'] > 0:
-                print(f"  Raw → Tuned:      {change_overall:+d} ({change_overall/before_data['stats']['total_findings']*100:+.1f}%)")
-            print(f"{'='*60}")
-
-        # Print overall summary
-        print(f"\n\n{'='*60}")
-        print("OVERALL SUMMARY - ALL VULNERABILITIES")
-        print(f"{'='*60}")
-        print(f"\nTotal vulnerabilities processed: {len(all_results)}")
-        print(f"Output directory: {OUT_DIR}\n")
-        
-        total_before = sum(r['before_findings'] for r in all_results.values())
-        total_fixing = sum(r['fixing_findings'] for r in all_results.values())
-        total_tuning = sum(r['tuning_findings'] for r in all_results.values())
-        
-        print(f"Aggregate findings across all vulnerabilities:")
-        print(f"  Raw:        {total_before} findings")
-        print(f"  Fixed:      {total_fixing} findings")
-        print(f"  Fine-Tuned: {total_tuning} findings")
+        summary_lines = [
+            f"\n\n{'='*60}\n",
+            "OVERALL SUMMARY - ALL VULNERABILITIES\n",
+            f"{'='*60}\n",
+            f"\nTotal vulnerabilities processed: {len(all_results)}\n",
+            f"Output directory: {OUT_DIR}\n\n",
+            "Aggregate findings across all vulnerabilities:\n",
+            f"  Raw:        {total_before} findings\n",
+            f"  Fixed:      {total_fixing} findings\n",
+            f"  Fine-Tuned: {total_tuning} findings\n",
+        ]
         
         if total_before > 0:
-            print(f"\nAggregate changes:")
-            print(f"  Raw → Fixed:      {total_fixing - total_before:+d} ({(total_fixing - total_before)/total_before*100:+.1f}%)")
+            summary_lines.append("\nAggregate changes:\n")
+            summary_lines.append(f"  Raw → Fixed:      {total_fixing - total_before:+d} ({(total_fixing - total_before)/total_before*100:+.1f}%)\n")
             if total_fixing > 0:
-                print(f"  Fixed → Tuned:    {total_tuning - total_fixing:+d} ({(total_tuning - total_fixing)/total_fixing*100:+.1f}%)")
-            print(f"  Raw → Tuned:      {total_tuning - total_before:+d} ({(total_tuning - total_before)/total_before*100:+.1f}%)")
+                summary_lines.append(f"  Fixed → Tuned:    {total_tuning - total_fixing:+d} ({(total_tuning - total_fixing)/total_fixing*100:+.1f}%)\n")
+            summary_lines.append(f"  Raw → Tuned:      {total_tuning - total_before:+d} ({(total_tuning - total_before)/total_before*100:+.1f}%)\n")
         
-        print(f"\n📁 Individual reports generated:")
-        for vuln_type, result in all_results.items():
-            print(f"  • {vuln_type}: {result['report_path']}")
+        summary_lines.append(f"\n📄 Comparison data: {os.path.join(OUT_DIR, 'all_reports.jsonl')}\n")
+        if not args.no_html:
+            summary_lines.append(f"\n📁 Individual reports generated (view with: python {sys.argv[0]} serve --port {args.port}):\n")
+            summary_lines.extend(f"  • {vuln_type}: {report_url(result['report_path'], port=args.port)}\n" for vuln_type, result in all_results.items())
         
-        print(f"\n{'='*60}")
-        print("✓ Analysis complete!")
-        print(f"{'='*60}\n")
\ No newline at end of file
+        summary_lines.append(f"\n{'='*60}\n")
+        summary_lines.append("✓ Analysis complete!\n")
+        summary_lines.append(f"{'='*60}\n\n")
+        sys.stdout.write("".join(summary_lines))
+        sys.stdout.flush()